@@ -1,12 +1,18 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import boto3
 import os
 import pandas as pd
+import numpy as np
+import json
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import folium
-from streamlit_folium import st_folium
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import math
+import string
+import time
 
 
 load_dotenv()
@@ -20,6 +26,23 @@ AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
 
+# Large prefixes are listed in parallel as key ranges. A range that does not
+# fit in one page is split at the "/" folders found below it, while listing
+# threads are free, up to STATS_SPLIT_DEPTH splits deep; folders with a single
+# child (e.g. raster/ under an empty prefix) are descended without a split.
+# Pieces smaller than STATS_MIN_SPLIT_KEYS would cost more LIST calls than they save
+STATS_SPLIT_DEPTH = 5
+STATS_MIN_SPLIT_KEYS = 4000
+STATS_WORKERS = 32
+
+# Bucket-root manifest written by tile-scrapper.py describing each tile layout
+TILE_MANIFEST_KEY = "manifest.json"
+
+# Extensions treated as map tiles when looking for a sample key
+IMG_EXTS = ('.png', '.jpg', '.jpeg', '.webp', '.pbf')
+# Keys scanned per prefix before giving up on finding a sample tile
+SAMPLE_SCAN_LIMIT = 5000
+
 # --- AWS Client Initialization ---
 @st.cache_resource
 def get_s3_client():
@@ -29,10 +52,15 @@ def get_s3_client():
                 's3',
                 region_name=AWS_REGION,
                 aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                config=Config(max_pool_connections=STATS_WORKERS)
             )
         else:
-            return boto3.client('s3', region_name=AWS_REGION)
+            return boto3.client(
+                's3',
+                region_name=AWS_REGION,
+                config=Config(max_pool_connections=STATS_WORKERS)
+            )
     except Exception as e:
         st.error(f"Failed to initialize S3 client: {e}")
         return None
@@ -50,44 +78,195 @@ def format_size(size_bytes):
     s = round(size_bytes / p, 2)
     return f"{s} {size_name[i]}"
 
-def get_presigned_url(bucket, key, expiration=3600):
+@st.cache_data(ttl=3600, show_spinner=False)
+def _presigned_url_for_window(bucket, key, expiration, window):
+    # Expire at the end of the window so the cached URL never outlives it
+    expires_in = (window + 1) * expiration - int(time.time())
     try:
         return s3.generate_presigned_url(
             'get_object',
             Params={'Bucket': bucket, 'Key': key},
-            ExpiresIn=expiration
+            ExpiresIn=max(expires_in, 1)
         )
     except ClientError:
         return None
 
+SIZE_UNITS = np.array(["B", "KB", "MB", "GB", "TB", "PB"])
+
+def format_sizes(sizes):
+    """Vectorized format_size over an array of byte counts."""
+    sizes = np.asarray(sizes, dtype=np.float64)
+    idx = np.clip(np.floor(np.log(np.maximum(sizes, 1)) / np.log(1024)).astype(int), 0, 5)
+    scaled = np.round(sizes / np.power(1024.0, idx), 2)
+    labels = np.char.add(np.char.add(scaled.astype(str), " "), SIZE_UNITS[idx])
+    return np.where(sizes == 0, "0 B", labels)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def list_folder(bucket, prefix, max_keys=1000):
+    """First page of objects under prefix as a DataFrame, None if empty."""
+    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=max_keys)
+    if 'Contents' not in response:
+        return None
+    df = pd.DataFrame.from_records(response['Contents'], columns=['Key', 'Size', 'LastModified'])
+    df['Size'] = format_sizes(df['Size'].to_numpy())
+    return df.rename(columns={'LastModified': 'Last Modified'})
+
+def get_presigned_url(bucket, key, expiration=3600):
+    """
+    Presigned GET URL that stays identical across reruns for the rest of
+    the current expiration window, so browsers can cache the response.
+    """
+    return _presigned_url_for_window(bucket, key, expiration, int(time.time()) // expiration)
+
+def _split_points(bucket, folder, page_keys, end, parts):
+    """
+    Pick split points in (page_keys[-1], end) from the sub-folders of
+    `folder`, descending through folders with a single child, for up to
+    `parts` pieces. When the page just listed spans several sub-folders,
+    their density caps the pieces at about STATS_MIN_SPLIT_KEYS keys each.
+    Returns (folder, points); points is empty if the range is not worth splitting.
+    """
+    start_after = page_keys[-1]
+    while True:
+        response = s3.list_objects_v2(
+            Bucket=bucket, Prefix=folder, Delimiter='/', StartAfter=start_after
+        )
+        children = [p['Prefix'] for p in response.get('CommonPrefixes', [])
+                    if not end or p['Prefix'] < end]
+        files = [obj for obj in response.get('Contents', [])
+                 if not end or obj['Key'] <= end]
+        if len(children) != 1 or files:
+            break
+        folder = children[0]
+
+    # Sub-folders of `folder` that the listed page reached into
+    covered = [key[:key.index('/', len(folder)) + 1] for key in page_keys
+               if key.startswith(folder) and '/' in key[len(folder):]]
+    if len(set(covered)) > 1:
+        keys_per_child = len(covered) / (len(set(covered)) - 1)
+        parts = min(parts, int(keys_per_child * len(children) / STATS_MIN_SPLIT_KEYS))
+    if parts < 2 or len(children) < 2:
+        return folder, []
+
+    # children[0] holds the rest of page_keys[-1]'s folder (or follows it),
+    # so it is never a boundary on its own
+    step = math.ceil(len(children) / parts)
+    return folder, children[step::step]
+
+def _range_page(bucket, prefix, start_after, end, folder, parts):
+    """
+    List one page of the key range (start_after, end] and sum its sizes.
+    An empty start_after starts at the first key, an empty end runs to the last.
+    Returns (size, count, rest): rest is what is left of the range as
+    (start_after, end, folder) ranges, split into up to `parts` pieces.
+    """
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    response = s3.list_objects_v2(**params)
+
+    total_size = 0
+    page_keys = []
+    for obj in response.get('Contents', []):
+        if end and obj['Key'] > end:
+            return total_size, len(page_keys), []
+        total_size += obj['Size']
+        page_keys.append(obj['Key'])
+
+    if not response.get('IsTruncated'):
+        return total_size, len(page_keys), []
+
+    points = []
+    if parts > 1:
+        folder, points = _split_points(bucket, folder, page_keys, end, parts)
+    bounds = [page_keys[-1]] + points + [end]
+    rest = [(lo, hi, folder) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    return total_size, len(page_keys), rest
+
+@st.cache_data(ttl=600, show_spinner=False)
 def calculate_folder_stats(bucket, prefix):
     """
     Paginate through S3 to get total size and count.
-    Warning: specific to 'prefix', can be slow for millions of files.
+    The prefix is listed as key ranges on STATS_WORKERS threads, one page per
+    task; a range that needs more pages is split at the folders found below
+    it while threads are free, so hot folders such as raster/16/ are spread out.
+    Results are cached for 10 minutes; errors are raised, not cached.
     """
     total_size = 0
     total_count = 0
-    paginator = s3.get_paginator('list_objects_v2')
-    
-    # Show a spinner because this can take time
-    with st.spinner(f"Calculating total size for '{prefix}'..."):
-        try:
-            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        total_size += obj['Size']
-                        total_count += 1
-        except ClientError as e:
-            st.error(f"Error calculating stats: {e}")
-            return 0, 0
-            
+
+    with ThreadPoolExecutor(max_workers=STATS_WORKERS) as executor:
+        pending = {}
+
+        def submit(ranges, depth):
+            # Share the idle threads among the new ranges; no splits once busy
+            # or STATS_SPLIT_DEPTH deep
+            idle = max(0, STATS_WORKERS - len(pending) - len(ranges))
+            parts = 1 + idle // len(ranges) if depth < STATS_SPLIT_DEPTH else 1
+            for lo, hi, folder in ranges:
+                future = executor.submit(_range_page, bucket, prefix, lo, hi, folder, parts)
+                pending[future] = (depth, parts)
+
+        submit([("", "", prefix)], 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth, parts = pending.pop(future)
+                size, count, rest = future.result()
+                total_size += size
+                total_count += count
+                if len(rest) > 1:
+                    submit(rest, depth + 1)
+                elif rest:
+                    # Unsplit; if a split found no folders, stop retrying it
+                    submit(rest, STATS_SPLIT_DEPTH if parts > 1 else depth)
+
     return total_size, total_count
 
-def infer_tile_url(bucket, region, prefix, example_key):
+@st.cache_data(ttl=300, show_spinner=False)
+def find_sample_tile(bucket, prefix):
+    """
+    Find the first image key under prefix, stopping at the first match.
+    Numeric sub-folders (zoom levels) are searched before the rest of the prefix,
+    and each search stops after SAMPLE_SCAN_LIMIT keys.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+
+    top = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter='/')
+    zoom_dirs = [
+        p['Prefix'] for p in top.get('CommonPrefixes', [])
+        if p['Prefix'][len(prefix):-1].isdigit()
+    ]
+    zoom_dirs.sort(key=lambda p: int(p[len(prefix):-1]))
+
+    for search_prefix in zoom_dirs + [prefix]:
+        pages = paginator.paginate(
+            Bucket=bucket, Prefix=search_prefix,
+            PaginationConfig={'PageSize': 1000, 'MaxItems': SAMPLE_SCAN_LIMIT}
+        )
+        for page in pages:
+            for obj in page.get('Contents', []):
+                if obj['Key'].lower().endswith(IMG_EXTS):
+                    return obj['Key']
+
+    return None
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_tile_manifest(bucket):
+    """Read the scraper's manifest.json from the bucket root, {} if absent."""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=TILE_MANIFEST_KEY)
+        return json.loads(response['Body'].read())
+    except (ClientError, ValueError):
+        return {}
+
+def infer_tile_url(bucket, region, prefix, example_key, layout=None):
     """
     Construct the Z/X/Y template URL using CloudFront.
     Example Key: raster/10/782/494.png
     Target: https://{base}/raster/{z}/{x}/{y}.png
+    For a hash-sharded layout (raster/{shard}/{z}/{x}/{y}.png) the shard is
+    dropped; CloudFront must rewrite the path to the sharded key.
     """
 
     base = os.getenv("BASE_URL_TILE")
@@ -107,12 +286,35 @@ def infer_tile_url(bucket, region, prefix, example_key):
         # Fix the extension part if it got messed up
         if not parts[-1].endswith(ext):
              parts[-1] = "{y}." + ext
+        # Shard segment is resolved at the edge, not in the template; keys
+        # from an unsharded run have no 2-hex-digit segment to drop
+        if (layout and layout.get("scheme") == "crc32-shard" and len(parts) >= 4
+                and len(parts[-4]) == 2 and all(c in string.hexdigits for c in parts[-4])):
+            del parts[-4]
         
         template_path = "/".join(parts)
         return f"{base}/{template_path}"
     
     return f"{base}/{prefix}{{z}}/{{x}}/{{y}}.{ext}"
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def build_map_html(tile_url, zoom, opacity, bucket):
+    """Render the Folium preview map to HTML, cached so reruns skip rebuilding it."""
+    m = folium.Map(location=[0, 0], zoom_start=zoom)
+
+    folium.TileLayer(
+        tiles=tile_url,
+        attr=f'S3 Bucket: {bucket}',
+        name='S3 Tiles',
+        overlay=True,
+        opacity=opacity
+    ).add_to(m)
+
+    # Add a base layer control
+    folium.LayerControl().add_to(m)
+
+    return m.get_root().render()
+
 # --- Main App Interface ---
 
 st.title("🗺️ S3 Tile & Data Explorer")
@@ -150,22 +352,20 @@ if selected_bucket:
             st.subheader(f"Contents: `{selected_bucket}/{prefix}`")
         with col2:
             if st.button("Calculate Total Size"):
-                t_size, t_count = calculate_folder_stats(selected_bucket, prefix)
+                # Show a spinner because this can take time
+                with st.spinner(f"Calculating total size for '{prefix}'..."):
+                    try:
+                        t_size, t_count = calculate_folder_stats(selected_bucket, prefix)
+                    except ClientError as e:
+                        st.error(f"Error calculating stats: {e}")
+                        t_size, t_count = 0, 0
                 st.metric("Total Size", format_size(t_size))
                 st.metric("File Count", f"{t_count:,}")
 
         # List first 1000 files for the table view
         try:
-            response = s3.list_objects_v2(Bucket=selected_bucket, Prefix=prefix, MaxKeys=1000)
-            if 'Contents' in response:
-                files = []
-                for obj in response['Contents']:
-                    files.append({
-                        "Key": obj['Key'],
-                        "Size": format_size(obj['Size']),
-                        "Last Modified": obj['LastModified']
-                    })
-                df = pd.DataFrame(files)
+            df = list_folder(selected_bucket, prefix)
+            if df is not None:
                 st.dataframe(df, use_container_width=True)
             else:
                 st.info("No files found.")
@@ -181,20 +381,21 @@ if selected_bucket:
         sample_key = None
         try:
             # Find a file that looks like an image
-            sample_res = s3.list_objects_v2(Bucket=selected_bucket, Prefix=prefix, MaxKeys=50)
-            if 'Contents' in sample_res:
-                for obj in sample_res['Contents']:
-                    if obj['Key'].lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.pbf')):
-                        sample_key = obj['Key']
-                        break
-        except:
+            sample_key = find_sample_tile(selected_bucket, prefix)
+        except ClientError:
             pass
 
         if sample_key:
             st.success(f"Detected sample tile: `{sample_key}`")
             
             # Infer URL
-            inferred_url = infer_tile_url(selected_bucket, AWS_REGION, prefix, sample_key)
+            layout = load_tile_manifest(selected_bucket).get(sample_key.split('/')[0])
+            inferred_url = infer_tile_url(selected_bucket, AWS_REGION, prefix, sample_key, layout)
+            if layout and layout.get("scheme") == "crc32-shard":
+                st.info(
+                    f"Tiles use a hash-sharded layout (`{layout['key_template']}`). "
+                    "The URL below assumes a CloudFront function rewrites `{z}/{x}/{y}` to the sharded key."
+                )
             
             # Controls
             col_m1, col_m2 = st.columns([2, 1])
@@ -211,20 +412,8 @@ if selected_bucket:
             
             # Map Rendering
             try:
-                m = folium.Map(location=[0, 0], zoom_start=zoom_start)
-                
-                folium.TileLayer(
-                    tiles=tile_url_input,
-                    attr=f'S3 Bucket: {selected_bucket}',
-                    name='S3 Tiles',
-                    overlay=True,
-                    opacity=opacity
-                ).add_to(m)
-                
-                # Add a base layer control
-                folium.LayerControl().add_to(m)
-
-                st_folium(m, width="100%", height=600)
+                map_html = build_map_html(tile_url_input, zoom_start, opacity, selected_bucket)
+                components.html(map_html, height=600)
 
             except Exception as e:
                 st.error(f"Error creating map: {e}")
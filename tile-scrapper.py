@@ -1,14 +1,32 @@
+import asyncio
+import collections
+import json
 import math
 import requests
+import aiohttp
+import aioboto3
 import boto3
 import logging
+import logging.handlers
+import queue
+import numpy as np
 import concurrent.futures
+import itertools
 import os
+import random
+import sqlite3
+import string
 import sys
+import threading
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
 from botocore.exceptions import NoCredentialsError, ClientError
+from boto3.s3.transfer import TransferConfig
+from diskcache import Cache
 from dotenv import load_dotenv
 from tqdm import tqdm
 import time
+import zlib
 
 # --- CONFIGURATION ---
 load_dotenv()
@@ -22,6 +40,13 @@ AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
 SOURCE_URL_PATTERN = os.getenv("SOURCE_URL_PATTERN")
 DESTINATION_PREFIX = "raster"
 
+# Spread tiles across 256 hash-prefixed key ranges ({prefix}/{shard}/{z}/{x}/{y}.png)
+# so S3 can partition writes beyond the per-prefix PUT rate limit
+HASH_SHARD = os.getenv("HASH_SHARD", "false").lower() in ("1", "true", "yes")
+
+# Bucket-root file recording the key layout of each destination prefix
+MANIFEST_KEY = "manifest.json"
+
 # Indonesia Complete Bounding Box (extended to cover all territories)
 # Includes: Sabang (Aceh), Papua, Rote Island, Sangihe-Talaud Islands
 # Order: West (Min Lon), South (Min Lat), East (Max Lon), North (Max Lat)
@@ -34,16 +59,27 @@ BOUNDING_BOX = [94.5, -11.5, 141.5, 6.0]
 MIN_ZOOM = 2
 MAX_ZOOM = 16  # Increase this for more detail (WARNING: exponential growth)
 
-# Number of concurrent threads
-MAX_WORKERS = 20  # Increased for faster scraping
+# Number of concurrent in-flight tile requests
+MAX_WORKERS = 200  # Single event loop, so this can be much higher than a thread count
+
+# Number of concurrent S3 uploads; None derives it from the benchmarked
+# GET:PUT latency ratio (falls back to MAX_WORKERS)
+UPLOAD_WORKERS = None
+MAX_UPLOAD_WORKERS_RATIO = 4  # derived uploaders are capped at MAX_WORKERS * this
+
+# Number of concurrent S3 listing shards when collecting existing tiles
+LIST_WORKERS = 16
 
 # Retry configuration
 MAX_RETRIES = 3
-RETRY_DELAY = 1  # seconds
+RETRY_DELAY = 1  # seconds, base of the exponential backoff
+MAX_RETRY_DELAY = 30  # seconds
 
-# Statistics (thread-safe)
-import threading
-stats_lock = threading.Lock()
+# Source statuses and S3 error codes that mean "slow down", not "missing"
+THROTTLE_STATUSES = (429, 503)
+S3_THROTTLE_CODES = ("SlowDown", "ThrottlingException", "RequestLimitExceeded")
+
+# Statistics (only updated from the event loop thread, so no lock is needed)
 stats = {
     "success": 0,
     "skipped": 0,
@@ -51,23 +87,64 @@ stats = {
     "not_found": 0
 }
 
+# Output mode: "s3" uploads one object per tile, "mbtiles" uploads one
+# MBTiles (SQLite) file per zoom level
+OUTPUT_MODE = "s3"
+MBTILES_DIR = "mbtiles"
+MBTILES_COMMIT_EVERY = 10000  # tiles per MBTiles transaction
+
+# Local cache of downloaded tile content, keyed by source URL, so a rerun
+# after a failed or interrupted upload does not download the tile again.
+# Entries are removed once the tile is stored (for MBTiles, committed)
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", ".tile_cache")
+TILE_CACHE_SIZE_LIMIT = 50 * 1024 ** 3  # bytes, least recently stored tiles are evicted first
+TILE_CACHE_EXPIRE = 7 * 86400  # seconds
+CACHE = None  # Opened in main unless --no-cache
+
+# --skip-ocean: tiles the source serves byte-identical for many coordinates
+# (e.g. open sea) are detected by (Content-Length, ETag) over the first
+# downloads, then later tiles are probed with HEAD and skipped on a match
+SKIP_EMPTY = False
+EMPTY_TILE_SAMPLE = 1000  # number of downloaded tiles inspected
+EMPTY_TILE_MIN_REPEATS = 20  # repeats for a signature to count as empty
+KNOWN_EMPTY_TILES = set()  # {(content_length, etag)}
+tile_signatures = collections.Counter()
+
 # Global args
 NO_CONFIRM = False
+USE_CACHE = True
 
 # --- LOGGING SETUP ---
-logging.basicConfig(
-    filename='missing_tiles.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
+# Workers only enqueue records; a background listener thread writes them
+# to disk so the scrape never blocks on log file I/O
+log_queue = queue.Queue(-1)
+file_handler = logging.FileHandler('missing_tiles.log')
+file_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
-)
+))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+
+# --- HTTP SESSION SETUP ---
+# Keep-alive session for the benchmark. Its GETs run one at a time against a
+# single host, so one pooled connection is enough; retries are disabled so a
+# retried request never inflates the measured GET time
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
 
 # --- S3 CLIENT SETUP ---
+# Synchronous client for listing and benchmarking; the pool must be at least
+# as large as the number of listing threads sharing it
 s3_client = boto3.client(
     's3',
     region_name=AWS_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=Config(max_pool_connections=LIST_WORKERS * 2)
 )
 
 def deg2num(lat_deg, lon_deg, zoom):
@@ -81,101 +158,491 @@ def deg2num(lat_deg, lon_deg, zoom):
     ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
     return (xtile, ytile)
 
-def check_exists(s3_key):
+def compile_url_pattern(pattern):
     """
-    Checks if the file already exists in S3 to avoid re-uploading.
-    Returns True if exists, False otherwise.
+    Checks a {z}/{x}/{y} URL pattern once at startup and returns its bound
+    str.format, called as url_of(z=z, x=x, y=y). Format specs such as
+    {z:03d} are allowed; raises ValueError for any other field.
     """
     try:
-        s3_client.head_object(Bucket=AWS_S3_BUCKET, Key=s3_key)
-        return True
+        pattern.format(z=0, x=0, y=0)
+    except KeyError as e:
+        raise ValueError(f"Unsupported field {e} in SOURCE_URL_PATTERN: {pattern}")
+    except IndexError:
+        raise ValueError(f"Positional fields are not supported in SOURCE_URL_PATTERN: {pattern}")
+    return pattern.format
+
+# Tile URL builder, set in main from SOURCE_URL_PATTERN
+tile_url = None
+
+def tile_key(z, x, y):
+    """Returns the S3 key for a tile, under its hash shard if HASH_SHARD is set."""
+    if HASH_SHARD:
+        shard = format(zlib.crc32(f"{z}/{x}/{y}".encode()) & 0xFF, '02x')
+        return f"{DESTINATION_PREFIX}/{shard}/{z}/{x}/{y}.png"
+    return f"{DESTINATION_PREFIX}/{z}/{x}/{y}.png"
+
+def write_manifest():
+    """
+    Records the tile key layout of DESTINATION_PREFIX in the bucket-root
+    manifest, so viewers or edge functions can map z/x/y to an S3 key.
+    Entries for other prefixes are preserved.
+    """
+    try:
+        response = s3_client.get_object(Bucket=AWS_S3_BUCKET, Key=MANIFEST_KEY)
+        manifest = json.loads(response['Body'].read())
     except ClientError as e:
-        # If error code is 404, it means the object does not exist
-        if e.response['Error']['Code'] == "404":
-            return False
-        # If it's another error (e.g. 403 Forbidden), re-raise or log it
-        print(f"[WARNING] S3 Check Error for {s3_key}: {e}")
-        return False
+        if e.response['Error']['Code'] != "NoSuchKey":
+            print(f"[WARNING] Could not read {MANIFEST_KEY}, not updating it: {e}")
+            return
+        manifest = {}
+    except ValueError as e:
+        print(f"[WARNING] Invalid {MANIFEST_KEY}, not updating it: {e}")
+        return
+
+    if HASH_SHARD:
+        manifest[DESTINATION_PREFIX] = {
+            "scheme": "crc32-shard",
+            "key_template": f"{DESTINATION_PREFIX}/{{shard}}/{{z}}/{{x}}/{{y}}.png",
+            "shard": "format(crc32('{z}/{x}/{y}') & 0xFF, '02x')"
+        }
+    else:
+        manifest[DESTINATION_PREFIX] = {
+            "scheme": "xyz",
+            "key_template": f"{DESTINATION_PREFIX}/{{z}}/{{x}}/{{y}}.png"
+        }
+
+    try:
+        s3_client.put_object(
+            Bucket=AWS_S3_BUCKET,
+            Key=MANIFEST_KEY,
+            Body=json.dumps(manifest, indent=2),
+            ContentType='application/json'
+        )
+    except ClientError as e:
+        print(f"[WARNING] Could not write {MANIFEST_KEY}, continuing without it: {e}")
+
+def list_keys(prefix):
+    """
+    Lists every S3 key under a prefix (1000 keys per request).
+    Returns the keys collected so far if listing fails part-way.
+    """
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    try:
+        for page in paginator.paginate(Bucket=AWS_S3_BUCKET, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    except ClientError as e:
+        print(f"[WARNING] S3 List Error for {prefix}: {e}")
+    return keys
+
+def tile_bitmap(detail):
+    """
+    Returns a cleared bitmap with one bit per tile of a zoom range from
+    calculate_tile_count, indexed in iter_tiles order. At one bit per tile
+    even zoom 16 fits in a few MB, where a set of keys needs gigabytes.
+    """
+    return bytearray((detail[1] + 7) // 8)
+
+def mark_tile(bitmap, detail, x, y):
+    """Sets the bit of tile (x, y); tiles outside the zoom range are ignored."""
+    _, _, start_x, end_x, start_y, end_y = detail
+    if start_x <= x <= end_x and start_y <= y <= end_y:
+        i = (x - start_x) * (end_y - start_y + 1) + (y - start_y)
+        bitmap[i >> 3] |= 1 << (i & 7)
+
+def list_existing_tiles(detail):
+    """
+    Returns a bitmap (see tile_bitmap) of the tiles of one zoom range already
+    in S3. The zoom prefix is sharded (by hash shard, or by the first digit
+    of X) so the shards can be listed in parallel as independent key-range
+    scans; keys are marked page by page instead of being collected.
+    """
+    z = detail[0]
+    if HASH_SHARD:
+        prefixes = [f"{DESTINATION_PREFIX}/{shard:02x}/{z}/" for shard in range(256)]
+    else:
+        prefixes = [f"{DESTINATION_PREFIX}/{z}/{digit}" for digit in string.digits]
+    existing = tile_bitmap(detail)
+    lock = threading.Lock()
+
+    def mark_shard(prefix):
+        zoom_dir = prefix[:prefix.rindex("/") + 1]
+        paginator = s3_client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=AWS_S3_BUCKET, Prefix=prefix):
+                tiles = []
+                for obj in page.get('Contents', []):
+                    x, _, name = obj['Key'][len(zoom_dir):].partition("/")
+                    if name.endswith(".png") and x.isdigit() and name[:-4].isdigit():
+                        tiles.append((int(x), int(name[:-4])))
+                with lock:
+                    for x, y in tiles:
+                        mark_tile(existing, detail, x, y)
+        except ClientError as e:
+            tqdm.write(f"[WARNING] S3 List Error for {prefix}: {e}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        list(executor.map(mark_shard, prefixes))
 
-def update_stats(key):
-    """Thread-safe stats update."""
-    with stats_lock:
-        stats[key] += 1
+    return existing
 
-def upload_tile(z, x, y, pbar=None):
+def update_stats(key, count=1):
+    """Stats update."""
+    stats[key] += count
+
+def backoff_delay(attempt, retry_after=None):
     """
-    Downloads a single tile and uploads it to S3 with retry logic.
+    Exponential backoff with full jitter, so throttled workers spread out
+    their retries instead of retrying in lockstep. A Retry-After header
+    (in seconds) from the source is used as a lower bound.
     """
-    url = SOURCE_URL_PATTERN.format(z=z, x=x, y=y)
-    s3_key = f"{DESTINATION_PREFIX}/{z}/{x}/{y}.png"
+    delay = random.uniform(0, RETRY_DELAY * 2 ** attempt)
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return min(MAX_RETRY_DELAY, delay)
 
-    if check_exists(s3_key):
-        update_stats("skipped")
-        if pbar:
-            pbar.update(1)
-        return "skipped"
+def observe_tile_signature(length, etag):
+    """
+    Counts tile signatures over the first EMPTY_TILE_SAMPLE downloads and
+    marks one as empty once it repeats EMPTY_TILE_MIN_REPEATS times.
+    `length` is the Content-Length header, the value the HEAD probe sees;
+    responses without one (chunked) cannot be probed and are not counted.
+    """
+    if length is None or not etag or tile_signatures.total() >= EMPTY_TILE_SAMPLE:
+        return
+    signature = (length, etag)
+    tile_signatures[signature] += 1
+    if tile_signatures[signature] >= EMPTY_TILE_MIN_REPEATS:
+        KNOWN_EMPTY_TILES.add(signature)
+
+async def is_known_empty(session, url):
+    """
+    Probes a tile with HEAD and returns True if its (Content-Length, ETag)
+    matches a known empty tile. Probe errors fall back to a normal download.
+    """
+    try:
+        async with session.head(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            signature = (response.content_length, response.headers.get("ETag"))
+            return response.status == 200 and signature in KNOWN_EMPTY_TILES
+    except Exception:
+        return False
+
+async def download_tile(session, z, x, y, url):
+    """
+    Downloads a single tile from `url` with retry logic.
+    Returns the tile content, or "not_found" / "failed".
+    """
+    if SKIP_EMPTY and KNOWN_EMPTY_TILES and await is_known_empty(session, url):
+        logging.info(f"Empty tile skipped: {z}/{x}/{y}")
+        return "not_found"
 
     for attempt in range(MAX_RETRIES):
+        retry_after = None
         try:
-            response = requests.get(url, stream=True, timeout=15)
-            
-            if response.status_code == 200:
-                content = response.content
-                if len(content) > 0:
-                    s3_client.put_object(
-                        Bucket=AWS_S3_BUCKET,
-                        Key=s3_key,
-                        Body=content,
-                        ContentType='image/png'
-                    )
-                    update_stats("success")
-                    if pbar:
-                        pbar.update(1)
-                    return "success"
-                else:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                if response.status == 200:
+                    # Reject empty tiles from the header without reading the body
+                    content = await response.read() if response.content_length != 0 else b""
+                    if len(content) > 0:
+                        if SKIP_EMPTY:
+                            observe_tile_signature(response.content_length, response.headers.get("ETag"))
+                        return content
                     logging.warning(f"Empty content: {z}/{x}/{y}")
-                    
-            elif response.status_code == 404:
-                logging.info(f"404 Not Found: {z}/{x}/{y}")
-                update_stats("not_found")
-                if pbar:
-                    pbar.update(1)
-                return "not_found"
-            else:
-                logging.warning(f"HTTP {response.status_code}: {z}/{x}/{y}")
-                
-        except requests.exceptions.Timeout:
+
+                elif response.status == 404:
+                    logging.info(f"404 Not Found: {z}/{x}/{y}")
+                    return "not_found"
+                elif response.status in THROTTLE_STATUSES:
+                    logging.warning(f"HTTP {response.status} throttled (attempt {attempt+1}): {z}/{x}/{y}")
+                    retry_after = response.headers.get("Retry-After")
+                else:
+                    logging.warning(f"HTTP {response.status}: {z}/{x}/{y}")
+
+        except asyncio.TimeoutError:
             logging.warning(f"Timeout (attempt {attempt+1}): {z}/{x}/{y}")
         except Exception as e:
             logging.error(f"Exception (attempt {attempt+1}): {z}/{x}/{y} - {str(e)}")
-        
+
         if attempt < MAX_RETRIES - 1:
-            time.sleep(RETRY_DELAY)
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
 
-    update_stats("failed")
     logging.error(f"Failed after {MAX_RETRIES} attempts: {z}/{x}/{y}")
-    if pbar:
-        pbar.update(1)
     return "failed"
 
+async def store_tile(s3, z, x, y, content, db=None):
+    """
+    Uploads a downloaded tile to S3 with retry logic. If `db` is given the
+    tile is written to that MBTiles connection instead.
+    Returns "success", "skipped" or "failed".
+    """
+    if db is not None:
+        # MBTiles uses TMS rows, flipped from XYZ
+        db.execute(
+            "INSERT OR REPLACE INTO tiles "
+            "(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+            (z, x, (1 << z) - 1 - y, content)
+        )
+        return "success"
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            # Conditional write: S3 rejects the PUT if the key
+            # appeared after the existing-key listing
+            await s3.put_object(
+                Bucket=AWS_S3_BUCKET,
+                Key=tile_key(z, x, y),
+                Body=content,
+                ContentType='image/png',
+                IfNoneMatch='*'
+            )
+            return "success"
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'PreconditionFailed':
+                return "skipped"
+            if code in S3_THROTTLE_CODES:
+                logging.warning(f"S3 {code} (attempt {attempt+1}): {z}/{x}/{y}")
+            else:
+                logging.error(f"Upload exception (attempt {attempt+1}): {z}/{x}/{y} - {str(e)}")
+        except Exception as e:
+            logging.error(f"Upload exception (attempt {attempt+1}): {z}/{x}/{y} - {str(e)}")
+
+        if attempt < MAX_RETRIES - 1:
+            await asyncio.sleep(backoff_delay(attempt))
+
+    logging.error(f"Upload failed after {MAX_RETRIES} attempts: {z}/{x}/{y}")
+    return "failed"
+
+async def cache_call(method, *args, **kwargs):
+    """
+    Runs a CACHE method off the event loop (diskcache blocks on SQLite and
+    file I/O). Returns None without a cache; cache errors such as a full
+    disk are logged and also return None, so the tile is simply not cached.
+    """
+    if CACHE is None:
+        return None
+    try:
+        return await asyncio.to_thread(getattr(CACHE, method), *args, **kwargs)
+    except Exception as e:
+        logging.warning(f"Tile cache {method} failed: {str(e)}")
+        return None
+
+def iter_tiles(details):
+    """
+    Lazily yields (z, x, y) for every tile in the ranges from calculate_tile_count,
+    X-major, so the n-th tile of a zoom is bit n of its tile_bitmap.
+    """
+    for z, _, start_x, end_x, start_y, end_y in details:
+        for x, y in itertools.product(range(start_x, end_x + 1), range(start_y, end_y + 1)):
+            yield z, x, y
+
+async def scrape_all(details, pbar, db=None):
+    """
+    Scrapes every tile in `details` as a two-stage pipeline on one event loop:
+    MAX_WORKERS downloaders feed UPLOAD_WORKERS uploaders through bounded
+    queues, so source GETs overlap with S3 PUTs and memory stays bounded.
+    Tiles already in S3 (or in `db`) are skipped, listed one zoom at a time.
+    """
+    upload_workers = UPLOAD_WORKERS or MAX_WORKERS
+    download_q = asyncio.Queue(maxsize=MAX_WORKERS * 4)
+    upload_q = asyncio.Queue(maxsize=upload_workers * 4)
+    connector = aiohttp.TCPConnector(limit=MAX_WORKERS, limit_per_host=MAX_WORKERS)
+
+    # MBTiles rows are lost on interrupt until committed, so their cache
+    # entries are only evicted once the batch holding them is committed
+    uncommitted = []
+
+    def record(status):
+        update_stats(status)
+        pbar.update(1)
+
+    async def commit_batch():
+        db.commit()
+        batch = uncommitted[:]
+        uncommitted.clear()
+        for url in batch:
+            await cache_call("delete", url)
+
+    # Workers must survive any per-tile error: a dead worker stops draining
+    # its queue and the producer would block on put() forever
+    async def downloader(session):
+        while (item := await download_q.get()) is not None:
+            tile, url = item
+            try:
+                result = await cache_call("get", url)
+                if result is None:
+                    result = await download_tile(session, *tile, url)
+                    if isinstance(result, bytes):
+                        await cache_call("set", url, result, expire=TILE_CACHE_EXPIRE)
+            except Exception as e:
+                logging.error(f"Download worker error: {'/'.join(map(str, tile))} - {str(e)}")
+                result = "failed"
+            if isinstance(result, bytes):
+                await upload_q.put((tile, url, result))
+            else:
+                record(result)
+
+    async def uploader(s3):
+        while (item := await upload_q.get()) is not None:
+            (z, x, y), url, content = item
+            try:
+                status = await store_tile(s3, z, x, y, content, db)
+            except Exception as e:
+                logging.error(f"Upload worker error: {z}/{x}/{y} - {str(e)}")
+                status = "failed"
+            if status in ("success", "skipped"):
+                # Stored, so the S3 listing covers resume from here on
+                if db is None:
+                    await cache_call("delete", url)
+                else:
+                    uncommitted.append(url)
+                    if len(uncommitted) >= MBTILES_COMMIT_EVERY:
+                        await commit_batch()
+            record(status)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async with aioboto3.Session().client(
+            's3',
+            region_name=AWS_REGION,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            config=Config(max_pool_connections=upload_workers)
+        ) as s3:
+            downloaders = [asyncio.create_task(downloader(session)) for _ in range(MAX_WORKERS)]
+            uploaders = [asyncio.create_task(uploader(s3)) for _ in range(upload_workers)]
+
+            for detail in details:
+                # Listed just before the zoom is queued, so only one zoom's
+                # bitmap is held; the listing thread leaves in-flight tiles running
+                if db is None:
+                    existing = await asyncio.to_thread(list_existing_tiles, detail)
+                else:
+                    existing = existing_mbtiles_tiles(db, detail)
+                for i, (z, x, y) in enumerate(iter_tiles([detail])):
+                    if existing[i >> 3] & (1 << (i & 7)):
+                        record("skipped")
+                    else:
+                        # The URL is built once here and carried through both queues
+                        await download_q.put(((z, x, y), tile_url(z=z, x=x, y=y)))
+
+            # One sentinel per worker stops each stage once its queue is drained
+            for _ in downloaders:
+                await download_q.put(None)
+            await asyncio.gather(*downloaders)
+
+            for _ in uploaders:
+                await upload_q.put(None)
+            await asyncio.gather(*uploaders)
+
+            if db is not None:
+                await commit_batch()
+
+def open_mbtiles(path, z):
+    """Creates (or reopens) a single-zoom MBTiles file and returns the connection."""
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS tiles "
+        "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+    )
+    db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)"
+    )
+    db.execute("DELETE FROM metadata")
+    db.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)", [
+        ("name", f"{DESTINATION_PREFIX}-{z}"),
+        ("format", "png"),
+        ("minzoom", str(z)),
+        ("maxzoom", str(z)),
+        ("bounds", ",".join(str(v) for v in BOUNDING_BOX)),
+    ])
+    db.commit()
+    return db
+
+def existing_mbtiles_tiles(db, detail):
+    """Returns a bitmap (see tile_bitmap) of the tiles of a zoom range already in an MBTiles file."""
+    z = detail[0]
+    existing = tile_bitmap(detail)
+    rows = db.execute("SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?", (z,))
+    for x, row in rows:
+        # MBTiles uses TMS rows, flipped from XYZ
+        mark_tile(existing, detail, x, (1 << z) - 1 - row)
+    return existing
+
+def scrape_mbtiles(details, pbar):
+    """
+    Scrapes each zoom level into a local MBTiles file, then uploads it to S3
+    as a single multipart object. Zoom levels already in S3 are skipped;
+    zoom levels with failed tiles are kept locally and not uploaded, and a
+    rerun only fetches the tiles missing from the local file.
+    """
+    os.makedirs(MBTILES_DIR, exist_ok=True)
+    transfer_config = TransferConfig(
+        multipart_chunksize=64 * 1024 * 1024,
+        max_concurrency=LIST_WORKERS
+    )
+
+    for detail in details:
+        z, count = detail[0], detail[1]
+        s3_key = f"{DESTINATION_PREFIX}/{z}.mbtiles"
+
+        if s3_key in list_keys(s3_key):
+            update_stats("skipped", count)
+            pbar.update(count)
+            continue
+
+        path = os.path.join(MBTILES_DIR, f"{z}.mbtiles")
+        failed_before = stats["failed"]
+        db = open_mbtiles(path, z)
+        try:
+            asyncio.run(scrape_all([detail], pbar, db))
+        finally:
+            db.close()
+
+        # An uploaded zoom is skipped on later runs, so never upload a partial one
+        failed = stats["failed"] - failed_before
+        if failed:
+            logging.error(f"Zoom {z}: {failed} tiles failed, {s3_key} not uploaded")
+            tqdm.write(f"Zoom {z}: {failed:,} tiles failed; not uploading, rerun to retry.")
+            continue
+
+        try:
+            s3_client.upload_file(path, AWS_S3_BUCKET, s3_key, Config=transfer_config)
+        except Exception as e:
+            logging.error(f"Zoom {z}: upload of {s3_key} failed - {str(e)}")
+            tqdm.write(f"Zoom {z}: upload failed ({e}); kept {path}, rerun to retry.")
+
 def calculate_tile_count(min_zoom, max_zoom, bbox):
-    """Calculate total number of tiles for given zoom range and bounding box."""
-    total = 0
-    details = []
+    """
+    Calculate total number of tiles for given zoom range and bounding box.
+    Vectorized over zoom levels; matches deg2num for each level.
+    """
     min_lon, min_lat, max_lon, max_lat = bbox
-    
-    for z in range(min_zoom, max_zoom + 1):
-        x_min, y_min = deg2num(max_lat, min_lon, z)
-        x_max, y_max = deg2num(min_lat, max_lon, z)
-        
-        start_x, end_x = min(x_min, x_max), max(x_min, x_max)
-        start_y, end_y = min(y_min, y_max), max(y_min, y_max)
-        
-        count = (end_x - start_x + 1) * (end_y - start_y + 1)
-        total += count
-        details.append((z, count, start_x, end_x, start_y, end_y))
-    
-    return total, details
+
+    z = np.arange(min_zoom, max_zoom + 1)
+    n = 2.0 ** z
+
+    def lon2x(lon_deg):
+        return ((lon_deg + 180.0) / 360.0 * n).astype(np.int64)
+
+    def lat2y(lat_deg):
+        lat_rad = np.radians(lat_deg)
+        return ((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n).astype(np.int64)
+
+    x_min, y_min = lon2x(min_lon), lat2y(max_lat)
+    x_max, y_max = lon2x(max_lon), lat2y(min_lat)
+
+    start_x, end_x = np.minimum(x_min, x_max), np.maximum(x_min, x_max)
+    start_y, end_y = np.minimum(y_min, y_max), np.maximum(y_min, y_max)
+
+    counts = (end_x - start_x + 1) * (end_y - start_y + 1)
+    details = list(zip(
+        z.tolist(), counts.tolist(),
+        start_x.tolist(), end_x.tolist(), start_y.tolist(), end_y.tolist()
+    ))
+
+    return int(counts.sum()), details
 
 def estimate_size(tile_count, avg_tile_size_kb=15):
     """Estimate total download size."""
@@ -185,8 +652,9 @@ def estimate_size(tile_count, avg_tile_size_kb=15):
 
 def benchmark_speed(num_samples=10):
     """
-    Benchmark download+upload speed by testing a few sample tiles.
-    Returns average time per tile in seconds.
+    Benchmark download and upload speed by testing a few sample tiles.
+    Returns (average GET time, average PUT time) per tile in seconds;
+    the PUT time is None if no sample could be downloaded.
     """
     print(f"\nBenchmarking speed with {num_samples} sample tiles...")
     
@@ -206,37 +674,49 @@ def benchmark_speed(num_samples=10):
             break
     
     sample_tiles = sample_tiles[:num_samples]
-    times = []
+    get_times = []
+    put_times = []
     
     for z, x, y in sample_tiles:
-        url = SOURCE_URL_PATTERN.format(z=z, x=x, y=y)
-        s3_key = f"{DESTINATION_PREFIX}/{z}/{x}/{y}.png"
+        url = tile_url(z=z, x=x, y=y)
+        s3_key = tile_key(z, x, y)
         
-        start = time.time()
         try:
             # Download
-            response = requests.get(url, stream=True, timeout=15)
+            start = time.time()
+            response = SESSION.get(url, timeout=15)
+            get_times.append(time.time() - start)
+            line = f"  Sample {len(get_times)}/{num_samples}: GET {get_times[-1]:.3f}s"
+
             if response.status_code == 200:
                 content = response.content
+                if SKIP_EMPTY:
+                    content_length = response.headers.get("Content-Length", "")
+                    observe_tile_signature(
+                        int(content_length) if content_length.isdigit() else None,
+                        response.headers.get("ETag")
+                    )
                 # Upload to S3
+                start = time.time()
                 s3_client.put_object(
                     Bucket=AWS_S3_BUCKET,
                     Key=s3_key,
                     Body=content,
                     ContentType='image/png'
                 )
-            elapsed = time.time() - start
-            times.append(elapsed)
-            print(f"  Sample {len(times)}/{num_samples}: {elapsed:.3f}s")
+                put_times.append(time.time() - start)
+                line += f", PUT {put_times[-1]:.3f}s"
+            print(line)
         except Exception as e:
             print(f"  Sample failed: {e}")
             continue
     
-    if not times:
+    if not get_times:
         return None
     
-    avg_time = sum(times) / len(times)
-    return avg_time
+    avg_get = sum(get_times) / len(get_times)
+    avg_put = sum(put_times) / len(put_times) if put_times else None
+    return avg_get, avg_put
 
 def format_duration(seconds):
     """Format seconds into human-readable duration."""
@@ -256,22 +736,32 @@ def format_duration(seconds):
 def estimate_time(total_tiles, avg_time_per_tile, workers):
     """Estimate total time considering parallel workers."""
     # Effective time = (total_tiles * avg_time) / workers
-    # Add 20% overhead for thread scheduling and S3 existence checks
+    # Add 20% overhead for scheduling and S3 listing
     effective_time = (total_tiles * avg_time_per_tile) / workers * 1.2
     return effective_time
 
 def main():
-    global stats
-    
+    global UPLOAD_WORKERS, CACHE, tile_url
+
     if not AWS_ACCESS_KEY_ID or not AWS_S3_BUCKET:
         print("Error: AWS credentials not found. Please check your .env file.")
         return
 
+    if not SOURCE_URL_PATTERN:
+        print("Error: SOURCE_URL_PATTERN not set. Please check your .env file.")
+        return
+
+    try:
+        tile_url = compile_url_pattern(SOURCE_URL_PATTERN)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
     print("=" * 60)
     print("INDONESIA TILE SCRAPER - Enhanced Version")
     print("=" * 60)
     print(f"Source: {SOURCE_URL_PATTERN}")
-    print(f"Target: s3://{AWS_S3_BUCKET}/{DESTINATION_PREFIX}/")
+    print(f"Target: s3://{AWS_S3_BUCKET}/{DESTINATION_PREFIX}/ ({OUTPUT_MODE})")
     print(f"Bounding Box: {BOUNDING_BOX}")
     print(f"Zoom Range: {MIN_ZOOM} to {MAX_ZOOM}")
     print("-" * 60)
@@ -289,12 +779,36 @@ def main():
     print("-" * 60)
     
     # Benchmark to estimate time
-    avg_time = benchmark_speed(num_samples=10)
-    if avg_time:
-        estimated_seconds = estimate_time(total_tiles, avg_time, MAX_WORKERS)
+    benchmark = benchmark_speed(num_samples=10)
+    if benchmark:
+        avg_get, avg_put = benchmark
+        # Size the upload stage so both stages drain tiles at the same rate;
+        # without PUT samples there is no ratio, so keep the MAX_WORKERS fallback
+        if UPLOAD_WORKERS is None and avg_put is not None and avg_get > 0:
+            UPLOAD_WORKERS = max(1, round(MAX_WORKERS * avg_put / avg_get))
+            # Each uploader holds an S3 connection, so a fast source must not
+            # turn into thousands of sockets and S3 SlowDown responses
+            upload_cap = MAX_WORKERS * MAX_UPLOAD_WORKERS_RATIO
+            if UPLOAD_WORKERS > upload_cap:
+                print(f"\nNote: {UPLOAD_WORKERS} upload workers derived from the benchmark, "
+                      f"capped at {upload_cap} (use --upload-workers to override)")
+                UPLOAD_WORKERS = upload_cap
+        upload_workers = UPLOAD_WORKERS or MAX_WORKERS
+
+        # The pipeline runs at the pace of its slower stage
+        estimated_seconds = estimate_time(total_tiles, avg_get, MAX_WORKERS)
+        if avg_put is not None:
+            estimated_seconds = max(
+                estimated_seconds,
+                estimate_time(total_tiles, avg_put, upload_workers)
+            )
         print(f"\nBenchmark Results:")
-        print(f"  Avg time per tile: {avg_time:.3f}s")
-        print(f"  Workers: {MAX_WORKERS}")
+        print(f"  Avg GET time per tile: {avg_get:.3f}s")
+        if avg_put is not None:
+            print(f"  Avg PUT time per tile: {avg_put:.3f}s")
+        else:
+            print("  Avg PUT time per tile: n/a (no sample uploaded)")
+        print(f"  Workers: {MAX_WORKERS} download, {upload_workers} upload")
         print(f"  Estimated total time: {format_duration(estimated_seconds)}")
     else:
         print("\nWarning: Could not benchmark speed (check network/credentials)")
@@ -306,27 +820,28 @@ def main():
             print("Aborted by user.")
             return
     
+    if OUTPUT_MODE == "s3":
+        write_manifest()
+
+    if USE_CACHE:
+        CACHE = Cache(TILE_CACHE_DIR, size_limit=TILE_CACHE_SIZE_LIMIT)
+        print(f"\nTile cache: {TILE_CACHE_DIR} ({len(CACHE):,} cached tiles)")
+
     print("\nStarting scrape...")
     start_time = time.time()
     
-    with tqdm(total=total_tiles, desc="Scraping tiles", unit="tile") as pbar:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = []
-            
-            for z in range(MIN_ZOOM, MAX_ZOOM + 1):
-                min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
-                
-                x_min, y_min = deg2num(max_lat, min_lon, z)
-                x_max, y_max = deg2num(min_lat, max_lon, z)
-
-                start_x, end_x = min(x_min, x_max), max(x_min, x_max)
-                start_y, end_y = min(y_min, y_max), max(y_min, y_max)
-
-                for x in range(start_x, end_x + 1):
-                    for y in range(start_y, end_y + 1):
-                        futures.append(executor.submit(upload_tile, z, x, y, pbar))
-
-            concurrent.futures.wait(futures)
+    log_listener.start()
+    try:
+        with tqdm(total=total_tiles, desc="Scraping tiles", unit="tile") as pbar:
+            if OUTPUT_MODE == "mbtiles":
+                scrape_mbtiles(details, pbar)
+            else:
+                asyncio.run(scrape_all(details, pbar))
+    finally:
+        # Flushes any queued records before exiting
+        log_listener.stop()
+        if CACHE is not None:
+            CACHE.close()
     
     elapsed = time.time() - start_time
     
@@ -349,7 +864,15 @@ def parse_args():
     parser.add_argument('--max-zoom', type=int, default=MAX_ZOOM,
                         help=f'Maximum zoom level (default: {MAX_ZOOM})')
     parser.add_argument('--workers', type=int, default=MAX_WORKERS,
-                        help=f'Number of concurrent workers (default: {MAX_WORKERS})')
+                        help=f'Number of concurrent downloads (default: {MAX_WORKERS})')
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS,
+                        help='Number of concurrent S3 uploads (default: from benchmarked GET:PUT ratio)')
+    parser.add_argument('--output', choices=['s3', 'mbtiles'], default=OUTPUT_MODE,
+                        help=f'Upload one object per tile or one MBTiles file per zoom (default: {OUTPUT_MODE})')
+    parser.add_argument('--skip-ocean', action='store_true',
+                        help='Skip tiles whose HEAD matches a repeated "empty" tile (e.g. open sea)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'Do not cache downloaded tiles in {TILE_CACHE_DIR}')
     parser.add_argument('--dry-run', action='store_true',
                         help='Only show tile count estimation, do not scrape')
     parser.add_argument('--no-confirm', '-y', action='store_true',
@@ -361,7 +884,11 @@ if __name__ == "__main__":
     MIN_ZOOM = args.min_zoom
     MAX_ZOOM = args.max_zoom
     MAX_WORKERS = args.workers
+    UPLOAD_WORKERS = args.upload_workers
     NO_CONFIRM = args.no_confirm
+    OUTPUT_MODE = args.output
+    USE_CACHE = not args.no_cache
+    SKIP_EMPTY = args.skip_ocean
     
     if args.dry_run:
         total_tiles, details = calculate_tile_count(MIN_ZOOM, MAX_ZOOM, BOUNDING_BOX)